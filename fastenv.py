@@ -5,7 +5,7 @@ import zipfile
 import hashlib
 import tkinter as tk
 from tkinter import messagebox, filedialog, ttk
-from threading import Thread
+from threading import Thread, Lock, Event
 import requests
 from urllib.parse import urlsplit
 from pathlib import Path
@@ -13,8 +13,10 @@ import logging
 import shutil
 import subprocess
 import json
+import tempfile
 from datetime import datetime
 from queue import Queue
+from concurrent.futures import ThreadPoolExecutor
 
 # # 配置日志
 # log_file = f"installer_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
@@ -34,35 +36,41 @@ TOOLS = {
         "bin_subdir": "bin",
         "is_single_exe": False,
         "description": "C/C++语言服务器，提供代码补全、错误检查等功能",
-        "version": "20.1.0"
+        "version": "20.1.0",
+        "probe": ["clangd", "--version"]
     },
     "ARM-GCC": {
         "url": "https://developer.arm.com/-/media/Files/downloads/gnu/14.2.rel1/binrel/arm-gnu-toolchain-14.2.rel1-mingw-w64-x86_64-arm-none-eabi.zip",
         "bin_subdir": "bin",
         "is_single_exe": False,
         "description": "ARM架构的GCC编译器工具链",
-        "version": "14.2.rel1"
+        "version": "14.2.rel1",
+        "probe": ["arm-none-eabi-gcc", "--version"]
     },
     "CMake": {
         "url": "https://github.com/Kitware/CMake/releases/download/v4.0.1/cmake-4.0.1-windows-x86_64.zip",
         "bin_subdir": "bin",
         "is_single_exe": False,
         "description": "跨平台构建工具",
-        "version": "4.0.1"
+        "version": "4.0.1",
+        "probe": ["cmake", "--version"]
     },
     "Ninja": {
         "url": "https://github.com/ninja-build/ninja/releases/download/v1.12.1/ninja-win.zip",
         "bin_subdir": "",
         "is_single_exe": True,
         "description": "小型构建系统，专注于速度",
-        "version": "1.12.1"
+        "version": "1.12.1",
+        "probe": ["ninja", "--version"]
     },
     "OpenOCD": {
         "url": "https://github.com/xpack-dev-tools/openocd-xpack/releases/download/v0.12.0-6/xpack-openocd-0.12.0-6-win32-x64.zip",
         "bin_subdir": "bin",
         "is_single_exe": False,
         "description": "片上调试器，用于嵌入式设备编程和调试",
-        "version": "0.12.0-6"
+        "version": "0.12.0-6",
+        "probe": ["openocd", "--version"],
+        "probe_version": "0.12.0"
     }
 }
 
@@ -70,9 +78,22 @@ TOOLS = {
 INSTALL_STEPS = [
     {"id": "download", "text": "下载", "color": "#2196f3"},
     {"id": "extract", "text": "解压", "color": "#ff9800"},
+    {"id": "verify", "text": "验证", "color": "#9c27b0"},
     {"id": "config", "text": "配置", "color": "#4caf50"}
 ]
 
+# 版本探测超时（秒）
+PROBE_TIMEOUT = 10
+
+# 探测结果缓存，按可执行文件的 (路径, 大小, 修改时间) 索引
+PROBE_CACHE_FILE = Path.home() / ".fastenv" / "probe_cache.json"
+
+# 解压单个文件时每次读写的块大小，取消请求在块之间检查
+EXTRACT_CHUNK_SIZE = 1024 * 1024
+
+# 等待子进程结束时检查取消请求的间隔（秒）
+PROCESS_POLL_INTERVAL = 0.05
+
 
 class ModernUI:
     """现代UI样式类"""
@@ -143,6 +164,150 @@ class ModernUI:
         return style
 
 
+class CancelToken:
+    """一次安装使用的取消标记，所有工具的所有步骤共用"""
+
+    def __init__(self):
+        self.event = Event()
+
+    def cancel(self):
+        self.event.set()
+
+    @property
+    def cancelled(self):
+        return self.event.is_set()
+
+
+def run_process(cmd, cancel_token=None, timeout=None, **kwargs):
+    """运行子进程并等待结束，期间检查取消标记；被取消时结束进程并返回 None"""
+    deadline = None if timeout is None else time.monotonic() + timeout
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE, stderr=subprocess.PIPE, **kwargs) as process:
+        while True:
+            try:
+                stdout, stderr = process.communicate(timeout=PROCESS_POLL_INTERVAL)
+                break
+            except subprocess.TimeoutExpired:
+                if cancel_token is not None and cancel_token.cancelled:
+                    process.kill()
+                    process.communicate()
+                    return None
+                if deadline is not None and time.monotonic() > deadline:
+                    process.kill()
+                    process.communicate()
+                    raise subprocess.TimeoutExpired(cmd, timeout)
+    return subprocess.CompletedProcess(cmd, process.returncode, stdout, stderr)
+
+
+class ToolVerifier:
+    """运行各工具的版本探测并缓存结果，文件不变时无需再次启动进程"""
+
+    def __init__(self, cache_file=PROBE_CACHE_FILE):
+        self.cache_file = Path(cache_file)
+        self.lock = Lock()
+        self.cache = self.load_cache()
+
+    def load_cache(self):
+        try:
+            with open(self.cache_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_cache(self):
+        # 多个安装线程会同时保存，写文件和替换都要在锁内完成
+        with self.lock:
+            # 旧版本目录被清理后，对应的缓存条目也一并丢弃
+            self.cache = {
+                key: output for key, output in self.cache.items()
+                if os.path.exists(key.rsplit("|", 2)[0])
+            }
+            try:
+                self.cache_file.parent.mkdir(parents=True, exist_ok=True)
+                # 临时文件名唯一，其他进程（如同时运行的 doctor）也不会写到同一个文件
+                with tempfile.NamedTemporaryFile('w', encoding='utf-8', dir=self.cache_file.parent,
+                                                 suffix=".tmp", delete=False) as f:
+                    json.dump(self.cache, f, ensure_ascii=False, indent=2)
+                os.replace(f.name, self.cache_file)
+            except OSError as e:
+                logging.warning(f"无法写入探测缓存 {self.cache_file}: {str(e)}")
+
+    def locate(self, tool_config, tool_dir=None):
+        """在安装目录中查找工具的可执行文件，未指定目录时从 PATH 查找"""
+        command = tool_config["probe"][0]
+        if tool_dir is None:
+            return shutil.which(command)
+
+        tool_dir = Path(tool_dir)
+        bin_dir = tool_dir if tool_config.get("is_single_exe", False) else tool_dir / tool_config["bin_subdir"]
+        return shutil.which(command, path=str(bin_dir))
+
+    def probe(self, tool_name, tool_config, exe_path, cancel_token=None):
+        """返回 (是否通过, 说明)"""
+        expected = tool_config.get("probe_version", tool_config["version"])
+        if not exe_path:
+            return False, "未找到可执行文件"
+
+        # 通过 current 链接找到的路径要解析到具体版本，切换版本后缓存自然失效
+        real_path = os.path.realpath(exe_path)
+        try:
+            stat = os.stat(real_path)
+        except OSError as e:
+            return False, f"无法访问 {exe_path}: {str(e)}"
+        cache_key = f"{real_path}|{stat.st_size}|{stat.st_mtime_ns}"
+
+        with self.lock:
+            output = self.cache.get(cache_key)
+
+        if output is None:
+            try:
+                result = run_process(
+                    [real_path] + tool_config["probe"][1:],
+                    cancel_token,
+                    timeout=PROBE_TIMEOUT,
+                    text=True,
+                    errors="replace",
+                    creationflags=getattr(subprocess, "CREATE_NO_WINDOW", 0)
+                )
+            except subprocess.TimeoutExpired:
+                return False, f"版本探测超时（{PROBE_TIMEOUT} 秒）"
+            except OSError as e:
+                return False, f"无法运行: {str(e)}"
+            if result is None:
+                return False, "已取消"
+
+            # 部分工具（如 OpenOCD）把版本信息输出到 stderr
+            output = (result.stdout + result.stderr).strip()
+            if result.returncode != 0:
+                return False, f"退出码 {result.returncode}: {output[:200]}"
+
+            with self.lock:
+                self.cache[cache_key] = output
+
+        first_line = output.splitlines()[0] if output else ""
+        if expected.lower() not in output.lower():
+            return False, f"版本不符，期望 {expected}，实际: {first_line}"
+        logging.info(f"{tool_name} 验证通过: {first_line}")
+        return True, first_line
+
+    def verify_all(self, tool_dirs=None, on_result=None):
+        """并发探测所有工具，tool_dirs 为 {工具名: 安装目录}，缺省时从 PATH 查找"""
+        tool_dirs = tool_dirs or {}
+
+        def verify(tool_name):
+            tool_config = TOOLS[tool_name]
+            exe_path = self.locate(tool_config, tool_dirs.get(tool_name))
+            ok, message = self.probe(tool_name, tool_config, exe_path)
+            if on_result:
+                on_result(tool_name, ok, message)
+            return tool_name, ok, message
+
+        with ThreadPoolExecutor(max_workers=len(TOOLS)) as executor:
+            results = list(executor.map(verify, TOOLS))
+
+        self.save_cache()
+        return results
+
+
 class InstallerApp:
     def __init__(self, root):
         self.root = root
@@ -160,7 +325,10 @@ class InstallerApp:
         self.threads = {}
         self.existing_files = {}
         self.installation_completed = False
+        self.cancel_token = CancelToken()
         self.ui_update_queue = Queue()
+        self.verifier = ToolVerifier()
+        self.path_lock = Lock()
 
         self.main_frame = tk.Frame(self.root, bg=ModernUI.COLORS["background"])
         self.main_frame.pack(fill=tk.BOTH, expand=True, padx=20, pady=20)
@@ -369,6 +537,15 @@ class InstallerApp:
         )
         self.cancel_button.pack(side=tk.RIGHT, padx=5)
 
+        self.rollback_button = ttk.Button(
+            button_frame,
+            text="回滚上一版本",
+            command=self.rollback_installation,
+            state=tk.DISABLED,
+            style="TButton"
+        )
+        self.rollback_button.pack(side=tk.LEFT, padx=20)
+
         self.status_bar = tk.Label(
             self.main_frame,
             text="准备就绪",
@@ -389,6 +566,7 @@ class InstallerApp:
             self.dir_label.config(text=f"安装目录: {directory}", fg=ModernUI.COLORS["text"])
 
             self.install_button.config(state=tk.NORMAL)
+            self.rollback_button.config(state=tk.NORMAL)
 
             self.scan_existing_files()
 
@@ -429,9 +607,12 @@ class InstallerApp:
             return
 
         self.installation_completed = False
+        # 每次安装使用新的标记，上一轮尚未退出的线程仍持有已取消的旧标记
+        self.cancel_token = CancelToken()
 
         self.install_button.config(state=tk.DISABLED)
         self.dir_button.config(state=tk.DISABLED)
+        self.rollback_button.config(state=tk.DISABLED)
 
         self.cancel_button.config(state=tk.NORMAL)
 
@@ -449,7 +630,7 @@ class InstallerApp:
 
             thread = Thread(
                 target=self.install_tool,
-                args=(tool_name, TOOLS[tool_name]),
+                args=(tool_name, TOOLS[tool_name], self.cancel_token),
                 daemon=True
             )
             self.threads[tool_name] = thread
@@ -458,9 +639,11 @@ class InstallerApp:
     def cancel_installation(self):
         if messagebox.askyesno("确认", "确定要取消安装吗？"):
             self.installation_completed = True
+            self.cancel_token.cancel()
             self.status_bar.config(text="安装已取消")
 
             self.dir_button.config(state=tk.NORMAL)
+            self.rollback_button.config(state=tk.NORMAL)
             self.install_button.config(state=tk.NORMAL)
             self.cancel_button.config(state=tk.DISABLED)
 
@@ -468,16 +651,18 @@ class InstallerApp:
                 if tool_name in self.threads and self.threads[tool_name].is_alive():
                     self.update_status(tool_name, "已取消", ModernUI.COLORS["error"])
 
-    def install_tool(self, tool_name, tool_config):
+    def install_tool(self, tool_name, tool_config, cancel_token):
         try:
-            if self.installation_completed:
+            if cancel_token.cancelled:
                 return
-            tool_dir = self.save_dir / Path(urlsplit(tool_config["url"]).path).stem
+            tool_root = self.save_dir / tool_name
             url = tool_config["url"]
             bin_subdir = tool_config["bin_subdir"]
             is_single_exe = tool_config.get("is_single_exe", False)
             filename = Path(urlsplit(url).path).name
             save_path = self.save_dir / filename
+            slot = f"{tool_config.get('version', 'unknown')}_{datetime.now().strftime('%Y%m%d%H%M%S%f')}"
+            staging_dir = tool_root / ".staging" / slot
 
             if tool_name in self.existing_files:
                 self.update_status(tool_name, "验证文件...", ModernUI.COLORS["info"])
@@ -485,35 +670,257 @@ class InstallerApp:
                 save_path = existing_file
             else:
                 self.update_status(tool_name, "下载中...", ModernUI.COLORS["info"])
-                self.download_file(url, save_path, tool_name)
+                self.download_file(url, save_path, tool_name, cancel_token)
 
-            if self.installation_completed:
+            if cancel_token.cancelled:
                 return
 
             self.update_status(tool_name, "解压中...", ModernUI.COLORS["info"])
-            extract_dir = self.extract_file(save_path, tool_dir, tool_name)
+            extract_dir = self.extract_file(save_path, staging_dir, tool_name, cancel_token)
 
-            if self.installation_completed:
+            # 解压中途取消时 extract_file 已经清理了暂存目录
+            if extract_dir is None:
+                return
+            if cancel_token.cancelled:
+                self.remove_dir_in_background(staging_dir)
                 return
 
             self.update_status(tool_name, "处理目录结构...", ModernUI.COLORS["info"])
-            actual_tool_dir = self.fix_directory_structure(extract_dir, bin_subdir, is_single_exe)
+            self.fix_directory_structure(extract_dir, bin_subdir, is_single_exe)
+
+            if cancel_token.cancelled:
+                self.remove_dir_in_background(staging_dir)
+                return
+
+            slot_dir = self.store_version(tool_root, staging_dir)
+
+            # 先验证新版本，通过后才切换 current，验证失败时正在使用的版本不受影响
+            self.update_status(tool_name, "验证中...", ModernUI.COLORS["info"])
+            try:
+                self.verify_tool(tool_name, tool_config, slot_dir, cancel_token)
+            except Exception:
+                self.remove_dir_in_background(slot_dir)
+                raise
 
-            if self.installation_completed:
+            if cancel_token.cancelled:
+                self.remove_dir_in_background(slot_dir)
                 return
 
+            self.update_status(tool_name, "切换版本...", ModernUI.COLORS["info"])
+            actual_tool_dir = self.activate_version(tool_root, slot_dir)
+
             self.update_status(tool_name, "配置环境变量...", ModernUI.COLORS["info"])
-            self.add_to_system_path(actual_tool_dir, bin_subdir, is_single_exe, tool_name)
+            self.add_to_system_path(actual_tool_dir, bin_subdir, is_single_exe, tool_name, cancel_token)
 
             self.update_status(tool_name, "完成", ModernUI.COLORS["success"])
 
             self.check_all_completed()
 
         except Exception as e:
+            if cancel_token.cancelled:
+                return
             self.update_status(tool_name, "失败", ModernUI.COLORS["error"])
             logging.error(f"{tool_name} 安装失败: {str(e)}", exc_info=True)
             messagebox.showerror("错误", f"{tool_name} 安装失败: {str(e)}")
 
+    def verify_tool(self, tool_name, tool_config, tool_dir, cancel_token):
+        exe_path = self.verifier.locate(tool_config, tool_dir)
+        ok, message = self.verifier.probe(tool_name, tool_config, exe_path, cancel_token)
+        self.verifier.save_cache()
+        if not ok:
+            raise Exception(f"验证失败: {message}")
+
+        self.ui_update_queue.put(lambda: self.step_progress_bars[tool_name]["verify"].set(100))
+        self.ui_update_queue.put(lambda: self.progress_bars[tool_name].set(75))
+
+    def store_version(self, tool_root, staging_dir):
+        """将暂存目录登记为新版本，此时 current 仍指向旧版本"""
+        versions_dir = tool_root / "versions"
+        versions_dir.mkdir(parents=True, exist_ok=True)
+        slot_dir = versions_dir / staging_dir.name
+        # 暂存目录与版本目录在同一卷上，改名是原子的
+        os.replace(staging_dir, slot_dir)
+        return slot_dir
+
+    def activate_version(self, tool_root, slot_dir):
+        """把 current 链接切换到新的版本目录"""
+        state = self.load_version_state(tool_root)
+        self.switch_current(tool_root, slot_dir)
+        self.save_version_state(tool_root, {
+            "current": slot_dir.name,
+            "previous": state.get("current")
+        })
+        logging.info(f"已激活版本: {slot_dir}")
+
+        self.cleanup_old_versions(tool_root)
+        return tool_root / "current"
+
+    def rollback_tool(self, tool_name):
+        """将工具切回上一个版本，成功返回 True"""
+        tool_root = self.save_dir / tool_name
+        state = self.load_version_state(tool_root)
+        previous = state.get("previous")
+        if not previous or not (tool_root / "versions" / previous).is_dir():
+            return False
+
+        self.switch_current(tool_root, tool_root / "versions" / previous)
+        self.save_version_state(tool_root, {
+            "current": previous,
+            "previous": state.get("current")
+        })
+        logging.info(f"{tool_name} 已回滚到版本: {previous}")
+        return True
+
+    def rollback_installation(self):
+        if not messagebox.askyesno("确认", "确定要将所有工具回滚到上一个版本吗？"):
+            return
+
+        rolled_back = [tool_name for tool_name in TOOLS if self.rollback_tool(tool_name)]
+        if rolled_back:
+            for tool_name in rolled_back:
+                self.update_status(tool_name, "已回滚", ModernUI.COLORS["info"])
+            self.status_bar.config(text=f"已回滚: {', '.join(rolled_back)}")
+        else:
+            messagebox.showinfo("提示", "没有可回滚的版本")
+
+    def switch_current(self, tool_root, slot_dir):
+        """把 tool_root/current 指向 slot_dir，正在使用旧版本的构建不受影响"""
+        current = tool_root / "current"
+        if os.name == "nt":
+            # Windows 上 rename 不能覆盖已有目录联接，直接改写联接的目标，
+            # current 在任何时刻都存在，失败时仍指向旧版本
+            if os.path.lexists(current):
+                self.set_junction_target(current, slot_dir)
+            else:
+                self.create_dir_link(current, slot_dir)
+            return
+
+        tmp_link = tool_root / f"current.{os.getpid()}.tmp"
+        if os.path.lexists(tmp_link):
+            os.unlink(tmp_link)
+        self.create_dir_link(tmp_link, slot_dir)
+        os.replace(tmp_link, current)
+
+    def create_dir_link(self, link_path, target):
+        if os.name == "nt":
+            # 目录联接不需要管理员权限或开发者模式
+            os.mkdir(link_path)
+            try:
+                self.set_junction_target(link_path, target)
+            except OSError:
+                os.rmdir(link_path)
+                raise
+        else:
+            os.symlink(target, link_path, target_is_directory=True)
+
+    def set_junction_target(self, link_path, target):
+        """通过 FSCTL_SET_REPARSE_POINT 原地设置目录联接的目标"""
+        import ctypes
+        from ctypes import wintypes
+
+        kernel32 = ctypes.WinDLL("kernel32", use_last_error=True)
+        kernel32.CreateFileW.argtypes = [
+            wintypes.LPCWSTR, wintypes.DWORD, wintypes.DWORD, wintypes.LPVOID,
+            wintypes.DWORD, wintypes.DWORD, wintypes.HANDLE
+        ]
+        kernel32.CreateFileW.restype = wintypes.HANDLE
+        kernel32.DeviceIoControl.argtypes = [
+            wintypes.HANDLE, wintypes.DWORD, wintypes.LPVOID, wintypes.DWORD,
+            wintypes.LPVOID, wintypes.DWORD, ctypes.POINTER(wintypes.DWORD), wintypes.LPVOID
+        ]
+        kernel32.DeviceIoControl.restype = wintypes.BOOL
+        kernel32.CloseHandle.argtypes = [wintypes.HANDLE]
+
+        generic_write = 0x40000000
+        open_existing = 3
+        flag_open_reparse_point = 0x00200000
+        flag_backup_semantics = 0x02000000
+        fsctl_set_reparse_point = 0x000900A4
+        io_reparse_tag_mount_point = 0xA0000003
+        invalid_handle_value = ctypes.c_void_p(-1).value
+
+        print_name = str(Path(target).absolute())
+        substitute_name = "\\??\\" + print_name
+        substitute_bytes = substitute_name.encode("utf-16-le")
+        print_bytes = print_name.encode("utf-16-le")
+        path_buffer = substitute_bytes + b"\0\0" + print_bytes + b"\0\0"
+        # REPARSE_DATA_BUFFER.MountPointReparseBuffer
+        reparse_data = (
+            (0).to_bytes(2, "little")
+            + len(substitute_bytes).to_bytes(2, "little")
+            + (len(substitute_bytes) + 2).to_bytes(2, "little")
+            + len(print_bytes).to_bytes(2, "little")
+            + path_buffer
+        )
+        data = (
+            io_reparse_tag_mount_point.to_bytes(4, "little")
+            + len(reparse_data).to_bytes(2, "little")
+            + (0).to_bytes(2, "little")
+            + reparse_data
+        )
+
+        handle = kernel32.CreateFileW(
+            str(link_path), generic_write, 0, None, open_existing,
+            flag_open_reparse_point | flag_backup_semantics, None
+        )
+        if handle == invalid_handle_value:
+            raise ctypes.WinError(ctypes.get_last_error())
+        try:
+            buffer = ctypes.create_string_buffer(data, len(data))
+            returned = wintypes.DWORD()
+            if not kernel32.DeviceIoControl(handle, fsctl_set_reparse_point, buffer, len(data),
+                                            None, 0, ctypes.byref(returned), None):
+                raise ctypes.WinError(ctypes.get_last_error())
+        finally:
+            kernel32.CloseHandle(handle)
+
+    def load_version_state(self, tool_root):
+        state_file = tool_root / "versions.json"
+        try:
+            with open(state_file, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def save_version_state(self, tool_root, state):
+        state_file = tool_root / "versions.json"
+        tmp_file = state_file.with_suffix(".json.tmp")
+        with open(tmp_file, 'w', encoding='utf-8') as f:
+            json.dump(state, f, ensure_ascii=False, indent=2)
+        os.replace(tmp_file, state_file)
+
+    def cleanup_old_versions(self, tool_root):
+        """后台删除当前版本和上一版本之外的旧版本以及残留的暂存目录"""
+        state = self.load_version_state(tool_root)
+        keep = {state.get("current"), state.get("previous")}
+
+        versions_dir = tool_root / "versions"
+        if versions_dir.is_dir():
+            for slot_dir in versions_dir.iterdir():
+                if slot_dir.name not in keep:
+                    self.remove_dir_in_background(slot_dir)
+
+        staging_root = tool_root / ".staging"
+        if staging_root.is_dir():
+            for leftover in staging_root.iterdir():
+                self.remove_dir_in_background(leftover)
+
+    def remove_dir_in_background(self, path):
+        def remove():
+            # 文件仍被占用时删除会失败，留到下次清理
+            shutil.rmtree(path, onerror=lambda func, p, exc: logging.warning(f"无法删除 {p}: {exc[1]}"))
+
+        Thread(target=remove, daemon=True).start()
+
+    def remove_file_in_background(self, path):
+        def remove():
+            try:
+                Path(path).unlink(missing_ok=True)
+            except OSError as e:
+                logging.warning(f"无法删除 {path}: {str(e)}")
+
+        Thread(target=remove, daemon=True).start()
+
     def fix_directory_structure(self, base_dir, bin_subdir, is_single_exe):
         base_dir = Path(base_dir).resolve()
         if is_single_exe:
@@ -547,8 +954,12 @@ class InstallerApp:
                     dst_item.unlink()
             shutil.move(str(item), str(dst_dir))
 
-    def download_file(self, url, save_path, tool_name, max_retries=3):
+    def download_file(self, url, save_path, tool_name, cancel_token, max_retries=3):
+        # 先写到本次下载独有的临时文件，完成后再改名；上一轮被取消的线程只会删除它自己的临时文件
+        part_path = save_path.with_name(f"{save_path.name}.{datetime.now().strftime('%Y%m%d%H%M%S%f')}.part")
         for attempt in range(max_retries):
+            if cancel_token.cancelled:
+                return False
             try:
                 response = requests.get(url, stream=True, timeout=30)
                 response.raise_for_status()
@@ -560,12 +971,12 @@ class InstallerApp:
                 save_path.parent.mkdir(parents=True, exist_ok=True)
 
                 downloaded = 0
-                with open(save_path, 'wb') as file:
+                with open(part_path, 'wb') as file:
                     for chunk in response.iter_content(chunk_size=8192):
                         if chunk:
-                            if self.installation_completed:
+                            if cancel_token.cancelled:
                                 file.close()
-                                save_path.unlink()
+                                self.remove_file_in_background(part_path)
                                 return False
 
                             file.write(chunk)
@@ -574,84 +985,178 @@ class InstallerApp:
                             download_progress = (downloaded / total_size) * 100
                             self.ui_update_queue.put(lambda p=download_progress: self.step_progress_bars[tool_name]["download"].set(p))
 
-                            total_progress = (downloaded / total_size) * 33
+                            total_progress = (downloaded / total_size) * 25
                             self.ui_update_queue.put(lambda p=total_progress: self.progress_bars[tool_name].set(p))
 
                             percent = (downloaded / total_size) * 100
                             self.status_bar.config(text=f"下载 {tool_name}: {self.format_size(downloaded)}/{self.format_size(total_size)} ({percent:.1f}%)")
 
+                os.replace(part_path, save_path)
                 return True
 
             except (requests.ConnectionError, requests.Timeout) as e:
                 if attempt < max_retries - 1:
                     logging.warning(f"下载 {tool_name} 失败，第 {attempt + 1} 次重试: {str(e)}")
-                    time.sleep(2 ** attempt)
+                    # 等待重试期间也响应取消
+                    if cancel_token.event.wait(2 ** attempt):
+                        return False
                     continue
+                self.remove_file_in_background(part_path)
                 raise Exception(f"下载失败（多次尝试后）: {str(e)}")
             except requests.HTTPError as e:
                 raise Exception(f"下载失败（HTTP错误）: {str(e)}")
             except Exception as e:
-                if save_path.is_file():
-                    save_path.unlink()
+                if part_path.is_file():
+                    part_path.unlink()
                 raise Exception(f"下载失败: {str(e)}")
 
-    def extract_file(self, save_path, tool_dir, tool_name):
+    def extract_file(self, save_path, staging_dir, tool_name, cancel_token):
+        """解压到独立的暂存目录，正在使用的版本在解压期间保持可用"""
         try:
-            if tool_dir.is_dir():
-                shutil.rmtree(tool_dir)
+            if staging_dir.is_dir():
+                shutil.rmtree(staging_dir)
 
-            tool_dir.mkdir(parents=True, exist_ok=True)
+            staging_dir.mkdir(parents=True, exist_ok=True)
 
             with zipfile.ZipFile(save_path, 'r') as zip_ref:
-                total_files = len(zip_ref.infolist())
+                members = zip_ref.infolist()
+                total_files = len(members)
+                total_bytes = sum(member.file_size for member in members) or 1
                 extracted = 0
+                extracted_bytes = 0
 
-                for file in zip_ref.infolist():
-                    if self.installation_completed:
+                for member in members:
+                    if cancel_token.cancelled:
+                        self.remove_dir_in_background(staging_dir)
                         return None
-                    zip_ref.extract(file, tool_dir)
-                    extracted += 1
 
-                    extract_progress = (extracted / total_files) * 100
-                    self.ui_update_queue.put(lambda p=extract_progress: self.step_progress_bars[tool_name]["extract"].set(p))
-
-                    total_progress = 33 + (extracted / total_files) * 33
-                    self.ui_update_queue.put(lambda p=total_progress: self.progress_bars[tool_name].set(p))
+                    target_path = self.member_target_path(staging_dir, member)
+                    if member.is_dir():
+                        target_path.mkdir(parents=True, exist_ok=True)
+                    else:
+                        target_path.parent.mkdir(parents=True, exist_ok=True)
+                        # 按块写出，像 cc1plus 这样的大文件也能在块之间响应取消
+                        with zip_ref.open(member) as src, open(target_path, 'wb') as dst:
+                            while True:
+                                if cancel_token.cancelled:
+                                    dst.close()
+                                    self.remove_dir_in_background(staging_dir)
+                                    return None
+                                chunk = src.read(EXTRACT_CHUNK_SIZE)
+                                if not chunk:
+                                    break
+                                dst.write(chunk)
+                                extracted_bytes += len(chunk)
+
+                                extract_progress = (extracted_bytes / total_bytes) * 100
+                                self.ui_update_queue.put(lambda p=extract_progress: self.step_progress_bars[tool_name]["extract"].set(p))
+
+                                total_progress = 25 + (extracted_bytes / total_bytes) * 25
+                                self.ui_update_queue.put(lambda p=total_progress: self.progress_bars[tool_name].set(p))
+                    extracted += 1
 
                     self.status_bar.config(text=f"解压 {tool_name}: {extracted}/{total_files} 文件")
 
-            return tool_dir
+            return staging_dir
         except Exception as e:
-            if tool_dir.is_dir():
-                shutil.rmtree(tool_dir)
+            self.remove_dir_in_background(staging_dir)
             raise Exception(f"解压失败: {str(e)}")
 
-    def add_to_system_path(self, tool_dir, bin_subdir, is_single_exe, tool_name):
+    def member_target_path(self, base_dir, member):
+        """与 ZipFile.extract 相同的路径清理规则，防止压缩包内的路径逃出解压目录"""
+        arcname = member.filename.replace('/', os.path.sep)
+        if os.path.altsep:
+            arcname = arcname.replace(os.path.altsep, os.path.sep)
+        arcname = os.path.splitdrive(arcname)[1]
+        invalid_path_parts = ('', os.path.curdir, os.path.pardir)
+        parts = [x for x in arcname.split(os.path.sep) if x not in invalid_path_parts]
+        if os.path.sep == '\\':
+            # 对应 ZipFile._sanitize_windows_name：替换 Windows 文件名中的非法字符并去掉结尾的点
+            table = str.maketrans(':<>|"?*', '_' * 7)
+            parts = [x.translate(table).rstrip('.') for x in parts]
+            parts = [x for x in parts if x]
+        return Path(base_dir).joinpath(*parts)
+
+    def add_to_system_path(self, tool_dir, bin_subdir, is_single_exe, tool_name, cancel_token):
         target_path = tool_dir if is_single_exe else tool_dir / bin_subdir
-        target_path = str(target_path.resolve())
+        # 不能 resolve，否则会跟随 current 链接把具体版本目录写进 PATH
+        target_path = str(target_path.absolute())
+        tool_config = TOOLS[tool_name]
 
-        try:
-            cmd = ["powershell.exe", "-NoProfile", "-Command",
-                   "[Environment]::SetEnvironmentVariable('PATH', " +
-                   "[Environment]::GetEnvironmentVariable('PATH', 'User') + ';" +
-                   f"{target_path}'" + ", 'User')"]
-
-            startupinfo = subprocess.STARTUPINFO()
-            startupinfo.dwFlags |= subprocess.STARTF_USESHOWWINDOW
-            result = subprocess.run(cmd, capture_output=True, text=True, startupinfo=startupinfo)
+        # 旧版安装器直接把 <压缩包名>/bin 写进 PATH，它排在 current 前面会让版本切换失效
+        legacy_dir = self.save_dir / Path(urlsplit(tool_config["url"]).path).stem
+        legacy_path = str((legacy_dir if is_single_exe else legacy_dir / bin_subdir).absolute())
 
-            if result.returncode != 0:
-                raise Exception(f"设置PATH失败: {result.stderr}")
+        def same_path(a, b):
+            return os.path.normcase(os.path.normpath(a)) == os.path.normcase(os.path.normpath(b))
 
-            logging.info(f"成功添加环境变量: {target_path}")
+        try:
+            # 各工具线程会同时走到这一步，读取到写回之间必须持锁，否则后写入的会覆盖先写入的条目
+            with self.path_lock:
+                user_path, value_type = self.read_user_path()
+                entries = [entry for entry in user_path.split(';') if entry]
+                # 条目中可能带有 %USERPROFILE% 之类的变量，比较时展开，写回时保持原样
+                new_entries = [entry for entry in entries if not same_path(os.path.expandvars(entry), legacy_path)]
+                if not any(same_path(os.path.expandvars(entry), target_path) for entry in new_entries):
+                    new_entries.append(target_path)
+
+                # 其他位置的同名工具排在前面时，切换版本不会生效，提示用户处理
+                shadowing = []
+                for entry in new_entries:
+                    expanded = os.path.expandvars(entry)
+                    if same_path(expanded, target_path):
+                        break
+                    if shutil.which(tool_config["probe"][0], path=expanded):
+                        shadowing.append(entry)
+
+                if cancel_token.cancelled:
+                    raise Exception("已取消")
+
+                if new_entries != entries:
+                    self.write_user_path(';'.join(new_entries), value_type)
+                    logging.info(f"成功添加环境变量: {target_path}")
+                else:
+                    logging.info(f"环境变量已存在: {target_path}")
 
             self.ui_update_queue.put(lambda: self.step_progress_bars[tool_name]["config"].set(100))
             self.ui_update_queue.put(lambda: self.progress_bars[tool_name].set(100))
-            messagebox.showinfo("配置成功", f"{tool_name} 环境变量配置成功！部分环境变量需要重启后生效。")
+
+            message = f"{tool_name} 环境变量配置成功！部分环境变量需要重启后生效。"
+            if shadowing:
+                logging.warning(f"{tool_name} 被 PATH 中更靠前的目录覆盖: {shadowing}")
+                message += "\n\n以下目录中的同名工具排在前面，请从 PATH 中移除:\n" + "\n".join(shadowing)
+            messagebox.showinfo("配置成功", message)
 
         except Exception as e:
             raise Exception(f"环境变量设置失败: {str(e)}")
 
+    def read_user_path(self):
+        """读取 HKCU\\Environment 中的 Path，返回 (值, 注册表类型)"""
+        import winreg
+
+        with winreg.OpenKey(winreg.HKEY_CURRENT_USER, "Environment") as key:
+            try:
+                return winreg.QueryValueEx(key, "Path")
+            except FileNotFoundError:
+                return "", winreg.REG_EXPAND_SZ
+
+    def write_user_path(self, value, value_type):
+        """写回用户 Path（保持原有的 REG_EXPAND_SZ/REG_SZ 类型），并通知其他程序环境变量已更新"""
+        import ctypes
+        import winreg
+
+        with winreg.OpenKey(winreg.HKEY_CURRENT_USER, "Environment", 0, winreg.KEY_SET_VALUE) as key:
+            winreg.SetValueEx(key, "Path", 0, value_type, value)
+
+        hwnd_broadcast = 0xFFFF
+        wm_settingchange = 0x001A
+        smto_abortifhung = 0x0002
+        result = ctypes.c_void_p()
+        ctypes.windll.user32.SendMessageTimeoutW(
+            hwnd_broadcast, wm_settingchange, 0, "Environment",
+            smto_abortifhung, 5000, ctypes.byref(result)
+        )
+
     def update_status(self, tool_name, status, color):
         self.ui_update_queue.put(
             lambda: self.status_labels[tool_name].config(text=status, fg=color)
@@ -669,6 +1174,7 @@ class InstallerApp:
             messagebox.showinfo("安装完成", "所有工具安装完成！\n部分环境变量需要重启后生效。")
 
             self.dir_button.config(state=tk.NORMAL)
+            self.rollback_button.config(state=tk.NORMAL)
             self.install_button.config(state=tk.NORMAL)
             self.cancel_button.config(state=tk.DISABLED)
 
@@ -689,7 +1195,29 @@ def check_dependencies():
         sys.exit(1)
 
 
+def run_doctor(args):
+    """fastenv doctor [安装目录]：并发检查所有工具能否正常运行"""
+    install_dir = Path(args[0]) if args else None
+    tool_dirs = {}
+    if install_dir is not None:
+        tool_dirs = {tool_name: install_dir / tool_name / "current" for tool_name in TOOLS}
+
+    def report(tool_name, ok, message):
+        print(f"[{'OK' if ok else '失败'}] {tool_name}: {message}", flush=True)
+
+    results = ToolVerifier().verify_all(tool_dirs, on_result=report)
+    failed = [tool_name for tool_name, ok, _ in results if not ok]
+    if failed:
+        print(f"以下工具未通过检查: {', '.join(failed)}")
+        return 1
+    print("所有工具均正常")
+    return 0
+
+
 def main():
+    if len(sys.argv) > 1 and sys.argv[1] == "doctor":
+        sys.exit(run_doctor(sys.argv[2:]))
+
     check_dependencies()
 
     root = tk.Tk()